@@ -1,13 +1,21 @@
 import argparse
 import os
 import secrets
+import sys
+import tempfile
 
 import uvicorn
 
+from uvicorn_worker import UvicornWorker as BaseUvicornWorker
 
-def run_app(reload: bool = False):
-    port = int(os.environ.get("KAGIAPI_PORT", 8000))
 
+class UvicornWorker(BaseUvicornWorker):
+    """Gunicorn worker that requires uvloop and httptools instead of falling back"""
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+def run_app(reload: bool = False):
     token_key = "ACCESS_TOKEN"
 
     os.environ[token_key] = os.environ.get(token_key) or secrets.token_urlsafe(32)
@@ -15,7 +23,64 @@ def run_app(reload: bool = False):
     if reload:
         os.environ["LOGGING_LEVEL"] = "DEBUG"
 
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=reload)
+    # Settings are read once on import, so only load them after the
+    # environment above is final
+    from settings import settings
+
+    if reload:
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=settings.KAGIAPI_PORT,
+            reload=True,
+            loop="uvloop",
+            http="httptools",
+        )
+        return
+
+    # Serve with multiple uvicorn workers managed by gunicorn
+    os.execv(
+        sys.executable,
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "main:app",
+            "--worker-class",
+            "app.UvicornWorker",
+            "--workers",
+            str(settings.KAGIAPI_WORKERS),
+            "--bind",
+            f"0.0.0.0:{settings.KAGIAPI_PORT}",
+            # Workers only heartbeat once the lifespan is done, which includes
+            # launching Chromium and logging into Kagi
+            "--timeout",
+            str(settings.KAGIAPI_WORKER_TIMEOUT),
+        ],
+    )
+
+
+def run_browser():
+    """Run a headless Chromium that app workers can share by setting CDP_URL"""
+    from playwright.sync_api import sync_playwright
+
+    from settings import settings
+
+    with sync_playwright() as p:
+        executable = p.chromium.executable_path
+
+    user_data_dir = tempfile.mkdtemp(prefix="kagiapi-chromium-")
+
+    os.execv(
+        executable,
+        [
+            executable,
+            "--headless",
+            "--no-sandbox",
+            f"--remote-debugging-port={settings.KAGIAPI_CDP_PORT}",
+            f"--user-data-dir={user_data_dir}",
+        ],
+    )
 
 
 if __name__ == "__main__":
@@ -23,6 +88,14 @@ if __name__ == "__main__":
     parser.add_argument(
         "--reload", action="store_true", help="Enable auto-reload for development"
     )
+    parser.add_argument(
+        "--browser",
+        action="store_true",
+        help="Run a shared headless Chromium for workers connecting via CDP_URL",
+    )
     args = parser.parse_args()
 
-    run_app(reload=args.reload)
+    if args.browser:
+        run_browser()
+    else:
+        run_app(reload=args.reload)
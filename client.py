@@ -4,15 +4,16 @@ Not a part of this application, but a demonstration for debugging and testing pu
 """
 
 import asyncio
-import os
 
 from fastmcp import Client
 from fastmcp.client.auth import BearerAuth
 from fastmcp.client.transports import StreamableHttpTransport
 
+from settings import settings
+
 
 async def main():
-    token = os.environ.get("ACCESS_TOKEN")
+    token = settings.ACCESS_TOKEN
     if not token:
         raise ValueError("Please set the ACCESS_TOKEN environment variable.")
     client = Client(
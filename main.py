@@ -1,41 +1,44 @@
 import asyncio
+import contextlib
+import datetime
+import hmac
 import logging
-import os
 
 from contextlib import asynccontextmanager
 from http import HTTPStatus
-from typing import Annotated, Any, Dict, Optional, Union
+from typing import Annotated, Any, AsyncIterator, Dict, Optional, Union
 from urllib.parse import urlparse
 
+import anyio
+import anyio.to_thread
+
 from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from fastmcp import FastMCP
 from fastmcp.server.auth.auth import OAuthProvider
+from markdownify import markdownify as md
 from mcp.server.auth.provider import AccessToken
-from playwright.async_api import ElementHandle, Page, async_playwright
+from playwright.async_api import (
+    Browser,
+    BrowserContext,
+    Error as PlaywrightError,
+    Locator,
+    Page,
+    Playwright,
+    Route,
+    TimeoutError as PlaywrightTimeoutError,
+    async_playwright,
+)
 from pydantic import BaseModel, Field
+from selectolax.lexbor import LexborHTMLParser
 
-
-logging_level = logging.INFO
-level = os.environ.get("LOGGING_LEVEL", "INFO").upper()
-if level == "DEBUG":
-    logging_level = logging.DEBUG
-elif level == "WARNING":
-    logging_level = logging.WARNING
-elif level == "ERROR":
-    logging_level = logging.ERROR
-elif level == "CRITICAL":
-    logging_level = logging.CRITICAL
-elif level == "NOTSET":
-    logging_level = logging.NOTSET
-elif level == "FATAL":
-    logging_level = logging.FATAL
+from settings import settings
 
 
 # Configure logging
 logging.basicConfig(
-    level=logging_level,
+    level=settings.LOGGING_LEVEL,
     format="%(asctime)s - %(levelname)s - %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S",
 )
@@ -45,11 +48,14 @@ class AccessTokenProvider(OAuthProvider):
     """A simple OAuth provider that uses an access token for authentication."""
 
     async def load_access_token(self, token: str):
-        if token != app.state.access_token:
+        if not hmac.compare_digest(token.encode(), app.state.access_token_bytes):
             return None
-        return AccessToken(token=token, scopes=["search"], client_id="kagi_client")
+        # Reuse the AccessToken built at startup, there is only one valid token
+        return app.state.mcp_access_token
 
     # --- Unused OAuth server methods ---
+    # The base protocol methods silently return None, so unsupported flows
+    # must be overridden to fail loudly instead of appearing to succeed.
     async def get_client(self, client_id: str):
         raise NotImplementedError("Client management not supported")
 
@@ -94,42 +100,223 @@ def create_mcp_server(app: FastAPI):
     return mcp_app.lifespan(mcp_app)
 
 
-def verify_auth(request: Request):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not (
-        auth_header.startswith("Bot ") or auth_header.startswith("Bearer ")
-    ):
+AUTH_SCHEMES = (b"Bot ", b"Bearer ")
+
+
+async def verify_auth(request: Request):
+    # Read the raw ASGI headers, their names are already lowercased bytes
+    auth_header = next(
+        (value for key, value in request.scope["headers"] if key == b"authorization"),
+        None,
+    )
+    if not auth_header or not auth_header.startswith(AUTH_SCHEMES):
         raise HTTPException(
             status_code=401, detail="Missing or invalid authorization header"
         )
-    token = auth_header.split(" ")[1]
-    if token != request.app.state.access_token:
+    _, _, token = auth_header.partition(b" ")
+    # Constant-time comparison to avoid leaking the token through timing
+    if not hmac.compare_digest(token, request.app.state.access_token_bytes):
         raise HTTPException(status_code=403, detail="Invalid access token")
 
 
+def limit_concurrency(pool: str):
+    """Queue requests beyond a pool's capacity instead of overloading Chromium"""
+
+    async def dependency(request: Request):
+        async with getattr(request.app.state, pool).limiter:
+            yield
+
+    return dependency
+
+
+# Resources that are never needed to extract text from a page
+SEARCH_BLOCKED_RESOURCES = frozenset({"image", "media", "font", "stylesheet"})
+FETCH_BLOCKED_RESOURCES = frozenset({"image", "media", "font"})
+
+
+async def launch_browser(p: Playwright) -> Browser:
+    if settings.CDP_URL:
+        # Share one Chromium between workers, each keeps isolated contexts
+        logging.debug(f"Connecting to Chromium over CDP at {settings.CDP_URL}")
+        browser = await p.chromium.connect_over_cdp(settings.CDP_URL)
+    else:
+        browser = await p.chromium.launch(headless=True)
+    browser.on("disconnected", on_browser_disconnected)
+    return browser
+
+
+def on_browser_disconnected(_: Browser):
+    logging.warning("Browser disconnected, it will be relaunched on next use")
+
+
+async def get_browser() -> Browser:
+    """Return the shared browser, relaunching it if it crashed or disconnected"""
+    async with app.state.browser_lock:
+        if not app.state.browser.is_connected():
+            app.state.browser = await launch_browser(app.state.playwright)
+        return app.state.browser
+
+
+class ContextPool:
+    """A fixed-size pool of pre-warmed browser contexts sharing the same setup"""
+
+    def __init__(
+        self,
+        size: int,
+        cookies: Optional[list] = None,
+        blocked_resources: frozenset[str] = frozenset(),
+        allowed_hosts: frozenset[str] = frozenset(),
+        recycle: bool = False,
+    ):
+        self.size = size
+        self.cookies = cookies
+        self.blocked_resources = blocked_resources
+        # When set, navigations (including JS redirects and frames) may only
+        # target these hosts
+        self.allowed_hosts = allowed_hosts
+        # Recycled pools never reuse a context, so no cookies or storage carry
+        # over from one request to the next
+        self.recycle = recycle
+        self._contexts: asyncio.Queue[BrowserContext] = asyncio.Queue(maxsize=size)
+        self._recycling: set[asyncio.Task] = set()
+        self.limiter = anyio.CapacityLimiter(size)
+
+    async def fill(self):
+        for _ in range(self.size):
+            self._contexts.put_nowait(await self.new_context())
+
+    async def close(self):
+        for task in self._recycling:
+            task.cancel()
+        await asyncio.gather(*self._recycling, return_exceptions=True)
+
+    async def new_context(self) -> BrowserContext:
+        browser = await get_browser()
+        # Service worker requests bypass context routing, block them so the
+        # resource filter below sees every request
+        ctx = await browser.new_context(service_workers="block")
+        if self.cookies:
+            await ctx.add_cookies(self.cookies)
+        if self.blocked_resources or self.allowed_hosts:
+            await ctx.route("**/*", self._handle_route)
+        return ctx
+
+    def is_allowed_url(self, url: str) -> bool:
+        if not self.allowed_hosts:
+            return True
+        try:
+            return urlparse(url).hostname in self.allowed_hosts
+        except ValueError:
+            # Fail closed on URLs that cannot be parsed
+            return False
+
+    async def _handle_route(self, route: Route):
+        request = route.request
+        if request.resource_type in self.blocked_resources or (
+            request.is_navigation_request() and not self.is_allowed_url(request.url)
+        ):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def _replace(self, ctx: BrowserContext) -> BrowserContext:
+        with contextlib.suppress(PlaywrightError):
+            await ctx.close()
+        try:
+            return await self.new_context()
+        except PlaywrightError as e:
+            # Keep the slot, the next request retries the replacement
+            logging.error(f"Failed to create a browser context: {e}")
+            return ctx
+
+    async def _recycle(self, ctx: BrowserContext):
+        try:
+            ctx = await self._replace(ctx)
+        finally:
+            # Always return the slot to the pool, even when cancelled
+            self._contexts.put_nowait(ctx)
+
+    @asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        ctx = await self._contexts.get()
+        failed = False
+        try:
+            try:
+                page = await ctx.new_page()
+            except PlaywrightError:
+                # The context died with its browser, retry once on a fresh one
+                ctx = await self._replace(ctx)
+                page = await ctx.new_page()
+            async with page:
+                yield page
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if failed or self.recycle:
+                # Swap in a fresh context in the background, so the response
+                # does not wait for the teardown and setup
+                task = asyncio.create_task(self._recycle(ctx))
+                self._recycling.add(task)
+                task.add_done_callback(self._recycling.discard)
+            else:
+                self._contexts.put_nowait(ctx)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     async with create_mcp_server(app):
-        access_token = os.environ.get("ACCESS_TOKEN")
+        access_token = settings.ACCESS_TOKEN
         if not access_token:
             raise ValueError("ACCESS_TOKEN environment variable is not set")
         logging.debug(f"Kagi authentication with access token: {access_token}")
-        app.state.access_token = access_token
-        token = os.environ.get("KAGI_TOKEN")
+        app.state.access_token_bytes = access_token.encode()
+        app.state.mcp_access_token = AccessToken(
+            token=access_token, scopes=["search"], client_id="kagi_client"
+        )
+        # Leave headroom for sync dependencies and offloaded work
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        limiter.total_tokens = settings.KAGIAPI_THREADS
+        token = settings.KAGI_TOKEN
         if not token:
             raise ValueError("KAGI_TOKEN environment variable is not set")
-        # Authenticate by token
+        # Keep one Playwright driver and browser for the whole app lifetime,
+        # requests only open lightweight contexts
         async with async_playwright() as p:
-            async with await p.chromium.launch(headless=True) as browser:
-                async with await browser.new_page() as page:
+            app.state.playwright = p
+            app.state.browser_lock = asyncio.Lock()
+            app.state.browser = await launch_browser(p)
+            pools: list[ContextPool] = []
+            try:
+                # Authenticate by token
+                async with await app.state.browser.new_page() as page:
                     await handle_token_authentication(page, token)
                     cks = await page.context.cookies()
-                    app.state.cookies = cks
                     logging.debug("Kagi authentication done.")
-        yield
-
-
-app = FastAPI(lifespan=lifespan)
+                # Pre-warm browser contexts and bound concurrent browser work
+                pool_size = settings.KAGIAPI_CONTEXTS
+                app.state.search_contexts = ContextPool(
+                    pool_size, cookies=cks, blocked_resources=SEARCH_BLOCKED_RESOURCES
+                )
+                app.state.fetch_contexts = ContextPool(
+                    pool_size,
+                    blocked_resources=FETCH_BLOCKED_RESOURCES,
+                    allowed_hosts=settings.FETCH_ALLOWED_HOSTS,
+                    recycle=True,
+                )
+                pools = [app.state.search_contexts, app.state.fetch_contexts]
+                for pool in pools:
+                    await pool.fill()
+                yield
+            finally:
+                for pool in pools:
+                    await pool.close()
+                browser = app.state.browser
+                browser.remove_listener("disconnected", on_browser_disconnected)
+                await browser.close()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -168,17 +355,12 @@ default_responses: Dict[Union[int, str], Dict[str, Any]] = {
 @app.exception_handler(Exception)
 async def exception_handler(_: Request, exc: Exception):
     """Global exception handler"""
+    code: int = HTTPStatus.INTERNAL_SERVER_ERROR
     if isinstance(exc, HTTPException):
-        code = exc.status_code or HTTPStatus.INTERNAL_SERVER_ERROR
-        return JSONResponse(
-            status_code=code,
-            content=ExceptionResponse(error=str(exc), code=code).model_dump(),
-        )
-    return JSONResponse(
-        status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-        content=ExceptionResponse(
-            error=str(exc), code=HTTPStatus.INTERNAL_SERVER_ERROR
-        ).model_dump(),
+        code = exc.status_code or code
+    # Same shape as ExceptionResponse, without the model round-trip
+    return ORJSONResponse(
+        status_code=code, content={"error": str(exc), "code": int(code)}
     )
 
 
@@ -188,58 +370,61 @@ class SearchResult(BaseModel):
     snippet: str = Field(..., description="Snippet of the search result")
 
 
+KAGI_HOME_URLS = frozenset({"https://kagi.com/", "https://kagi.com"})
+
+
 async def handle_token_authentication(page: Page, token: str):
     await page.goto(f"https://kagi.com/search?token={token}")
-    result = urlparse(page.url)
-    if result.path != "/":
+    # A valid token redirects to the home page, ignoring any query string
+    if page.url.partition("?")[0] not in KAGI_HOME_URLS:
         raise ValueError("Invalid token or authentication failed")
 
 
+# Kagi search page selectors, shared by the wait and the in-page extraction
+SEARCH_SELECTORS = {
+    "box": ".results-box",
+    "result": ".search-result",
+    "title": ".__sri-title",
+    "url": ".__sri-url-box a",
+    "snippet": ".__sri-desc",
+}
+
+# Runs in the page, skipping results that are missing a title, link or snippet
+PARSE_SEARCH_RESULTS_JS = """(box, sel) => Array.from(box.querySelectorAll(sel.result))
+    .map((result) => {
+        const title = result.querySelector(sel.title);
+        const url = result.querySelector(sel.url);
+        const snippet = result.querySelector(sel.snippet);
+        const href = url && url.getAttribute("href");
+        if (!title || !href || !snippet) {
+            return null;
+        }
+        return {
+            title: title.innerText,
+            url: href,
+            snippet: snippet.innerText,
+            t: 0,
+        };
+    })
+    .filter(Boolean)"""
+
+
 async def perform_search(page: Page, query: str) -> Optional[list[SearchResult]]:
     await page.goto(f"https://kagi.com/search?q={query}")
-    for _ in range(5):
-        result = await page.query_selector(".results-box")
-        if not result:
-            logging.debug(f"Search results not found for query: {query}, retrying...")
-            await asyncio.sleep(0.5)
-            continue
-        search_results = await result.query_selector_all(".search-result")
-        if len(search_results) == 0:
-            logging.debug(f"Search results not found for query: {query}, retrying...")
-            await asyncio.sleep(0.5)
-            continue
-        return await parse_search_results(search_results)
-
-
-async def parse_search_results(
-    search_results: list[ElementHandle],
-) -> list[SearchResult]:
-    results = []
-    for result in search_results:
-        title = await result.query_selector(".__sri-title")
-        if not title:
-            logging.debug("Search result title not found, skipping...")
-            continue
-        title = await title.inner_text()
-        url = await result.query_selector(".__sri-url-box")
-        if not url:
-            logging.debug("Search result URL not found, skipping...")
-            continue
-        url = await url.query_selector("a")
-        if not url:
-            logging.debug("Search result URL link not found, skipping...")
-            continue
-        url = await url.get_attribute("href")
-        if not url:
-            logging.debug("Search result URL attribute not found, skipping...")
-            continue
-        snippet = await result.query_selector(".__sri-desc")
-        if not snippet:
-            logging.debug("Search result snippet not found, skipping...")
-            continue
-        snippet = await snippet.inner_text()
-        results.append({"title": title, "url": url, "snippet": snippet, "t": 0})
-    return results
+    box = page.locator(SEARCH_SELECTORS["box"]).first
+    results = box.locator(SEARCH_SELECTORS["result"])
+    try:
+        await box.wait_for(state="visible", timeout=2500)
+        await results.first.wait_for(timeout=2500)
+    except PlaywrightTimeoutError:
+        logging.debug(f"Search results not found for query: {query}")
+        return None
+    return await parse_search_results(box)
+
+
+async def parse_search_results(box: Locator) -> list[SearchResult]:
+    # Extract every result in a single round-trip to the browser
+    return await box.evaluate(PARSE_SEARCH_RESULTS_JS, SEARCH_SELECTORS)
 
 
 class SearchRequest(BaseModel):
@@ -250,16 +435,16 @@ class SearchResponse(BaseModel):
     data: list[SearchResult] = Field(..., description="List of search results")
 
 
+# Serialized once, returned as-is whenever a search has no results
+EMPTY_SEARCH_BODY = ORJSONResponse({"data": []}).body
+
+
 async def _search(query: str):
-    async with async_playwright() as p:
-        cookies = app.state.cookies
-        async with await p.chromium.launch(headless=True) as browser:
-            async with await browser.new_page() as page:
-                await page.context.add_cookies(cookies)
-                # Perform a search
-                results = await perform_search(page, query)
+    async with app.state.search_contexts.page() as page:
+        # Perform a search
+        results = await perform_search(page, query)
     if not results:
-        return {"data": []}
+        return Response(content=EMPTY_SEARCH_BODY, media_type="application/json")
     return {"data": results}
 
 
@@ -272,6 +457,7 @@ async def _search(query: str):
 async def search(
     query: Annotated[SearchRequest, Query()],
     _dep: None = Depends(verify_auth),
+    _limit: None = Depends(limit_concurrency("search_contexts")),
 ):
     """Perform a search action"""
     return await _search(query.q)
@@ -281,6 +467,9 @@ class GetTimeResponse(BaseModel):
     time: str = Field(..., description="Current server time in ISO8601 format (UTC)")
 
 
+UTC = datetime.timezone.utc
+
+
 @app.get(
     "/api/time",
     operation_id="time",
@@ -289,15 +478,8 @@ class GetTimeResponse(BaseModel):
 )
 async def get_time():
     """Get the current time in ISO8601 format (UTC)"""
-    import datetime
-
-    now = (
-        datetime.datetime.now(datetime.timezone.utc)
-        .replace(microsecond=0)
-        .isoformat()
-        .replace("+00:00", "Z")
-    )
-    return {"time": now}
+    now = datetime.datetime.now(UTC)
+    return {"time": now.strftime("%Y-%m-%dT%H:%M:%SZ")}
 
 
 class FetchRequest(BaseModel):
@@ -308,6 +490,20 @@ class FetchResponse(BaseModel):
     content: str = Field(..., description="Fetched page content in markdown format")
 
 
+ALLOWED_FETCH_SCHEMES = frozenset({"http", "https"})
+
+# Elements whose content never ends up in the markdown output
+STRIPPED_TAGS = ["script", "style", "header", "footer", "noscript", "svg"]
+
+
+def html_to_markdown(content: str) -> str:
+    # Drop unwanted elements with the C parser first so markdownify walks a
+    # much smaller tree
+    tree = LexborHTMLParser(content)
+    tree.strip_tags(STRIPPED_TAGS)
+    return md(tree.html or "")
+
+
 @app.get(
     "/api/fetch",
     operation_id="fetch",
@@ -315,19 +511,34 @@ class FetchResponse(BaseModel):
     responses=default_responses,
 )
 async def fetch(
-    query: Annotated[FetchRequest, Query()], _dep: None = Depends(verify_auth)
+    query: Annotated[FetchRequest, Query()],
+    _dep: None = Depends(verify_auth),
+    _limit: None = Depends(limit_concurrency("fetch_contexts")),
 ):
     """Fetch page content by URL"""
-    async with async_playwright() as p:
-        async with await p.chromium.launch(headless=True) as browser:
-            async with await browser.new_page() as page:
-                try:
-                    await page.goto(query.url, timeout=5000)
-                    content = await page.content()
-                except Exception as e:
-                    logging.error(f"Failed to fetch content from {query.url}: {e}")
-                    content = ""
-
-    from markdownify import markdownify as md
-
-    return {"content": md(content, strip=["script", "style", "header", "footer"])}
+    try:
+        url = urlparse(query.url)
+        valid = url.scheme in ALLOWED_FETCH_SCHEMES and bool(url.hostname)
+    except ValueError:
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid URL")
+    pool: ContextPool = app.state.fetch_contexts
+    if not pool.is_allowed_url(query.url):
+        raise HTTPException(status_code=403, detail="URL host is not allowed")
+    try:
+        async with pool.page() as page:
+            await page.goto(query.url, timeout=5000)
+            # Routing does not see HTTP redirects, check where we ended up
+            if not pool.is_allowed_url(page.url):
+                raise HTTPException(status_code=403, detail="URL host is not allowed")
+            content = await page.content()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Failed to fetch content from {query.url}: {e}")
+        content = ""
+
+    # Converting large pages is CPU bound, keep it off the event loop
+    markdown = await anyio.to_thread.run_sync(html_to_markdown, content)
+    return {"content": markdown}
@@ -0,0 +1,61 @@
+"""Application settings, read once from environment variables at import time."""
+
+import logging
+import os
+
+from dataclasses import dataclass
+from typing import Mapping, Optional
+
+
+def _logging_level(name: str) -> int:
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        return logging.INFO
+    return level
+
+
+def _default_workers(env: Mapping[str, str]) -> int:
+    # Without a shared browser every worker launches its own Chromium and logs
+    # into Kagi, so only scale out by default when CDP_URL is set
+    if not env.get("CDP_URL"):
+        return 1
+    return os.cpu_count() or 1
+
+
+@dataclass(frozen=True)
+class Settings:
+    ACCESS_TOKEN: Optional[str]
+    KAGI_TOKEN: Optional[str]
+    LOGGING_LEVEL: int
+    KAGIAPI_PORT: int
+    KAGIAPI_WORKERS: int
+    KAGIAPI_WORKER_TIMEOUT: int
+    KAGIAPI_CONTEXTS: int
+    KAGIAPI_THREADS: int
+    KAGIAPI_CDP_PORT: int
+    CDP_URL: Optional[str]
+    FETCH_ALLOWED_HOSTS: frozenset[str]
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        env = os.environ
+        return cls(
+            ACCESS_TOKEN=env.get("ACCESS_TOKEN"),
+            KAGI_TOKEN=env.get("KAGI_TOKEN"),
+            LOGGING_LEVEL=_logging_level(env.get("LOGGING_LEVEL", "INFO")),
+            KAGIAPI_PORT=int(env.get("KAGIAPI_PORT", 8000)),
+            KAGIAPI_WORKERS=int(env.get("KAGIAPI_WORKERS", _default_workers(env))),
+            KAGIAPI_WORKER_TIMEOUT=int(env.get("KAGIAPI_WORKER_TIMEOUT", 120)),
+            KAGIAPI_CONTEXTS=int(env.get("KAGIAPI_CONTEXTS", 4)),
+            KAGIAPI_THREADS=int(env.get("KAGIAPI_THREADS", 100)),
+            KAGIAPI_CDP_PORT=int(env.get("KAGIAPI_CDP_PORT", 9222)),
+            CDP_URL=env.get("CDP_URL"),
+            FETCH_ALLOWED_HOSTS=frozenset(
+                host.strip().lower()
+                for host in env.get("FETCH_ALLOWED_HOSTS", "").split(",")
+                if host.strip()
+            ),
+        )
+
+
+settings = Settings.from_env()